@@ -1,73 +1,75 @@
 import argparse
 import random
 import boto3
-from internet_scholar import read_dict_from_s3_url, AthenaLogger, AthenaDatabase, compress, read_dict_from_url
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+import bz2
+from internet_scholar import read_dict_from_s3_url, AthenaLogger, AthenaDatabase, read_dict_from_url
 import logging
 import googleapiclient.discovery
-from googleapiclient.errors import HttpError, UnknownApiNameOrVersion
-import csv
+import googleapiclient.discovery_cache
+import googleapiclient.http
+from googleapiclient.errors import HttpError
 from pathlib import Path
-import json
-from datetime import datetime
+import orjson
+from datetime import datetime, timedelta
 import time
 import uuid
-from socket import error as SocketError
+import sqlite3
+import duckdb
+import pyarrow
+import pyarrow.parquet
+from socket import error as SocketError, timeout as SocketTimeout
 import errno
+from itertools import count, islice
+import threading
+from contextlib import closing, contextmanager
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
 
 SELECT_TWITTER_STREAM_VIDEO = """
-select distinct
-  url_extract_parameter(validated_url, 'v') as video_id,
-  1 as twitter_stream,
-  0 as youtube_related_video,
-  0 as twitter_search
+select
+  url_extract_parameter(validated_url, 'v') as video_id
 from
   validated_url
 where
   url_extract_host(validated_url) = 'www.youtube.com'
 """
 
-EXTRA_TWITTER_STREAM_VIDEO = """
-  and url_extract_parameter(validated_url, 'v') not in (select id from youtube_video_snippet)
-"""
-
 SELECT_YOUTUBE_RELATED_VIDEO = """
-select distinct
-  id.videoId as video_id,
-  0 as twitter_stream,
-  1 as youtube_related_video,
-  0 as twitter_search
+select
+  id.videoId as video_id
 from
   youtube_related_video
 """
 
-EXTRA_YOUTUBE_RELATED_VIDEO = """
-where
-  id.videoId not in (select id from youtube_video_snippet)
-"""
-
 SELECT_GROUP_BY = """
-with group_by_table as (
-{}
-)
 select
-  video_id,
-  sum(twitter_stream) as twitter_stream,
-  sum(youtube_related_video) as youtube_related_video,
-  sum(twitter_search) as twitter_search
+  video_id
 from
-  group_by_table
+  (
+{}
+  ) group_by_table
+where
+  video_id is not null
 group by
   video_id
 """
 
-SELECT_COUNT = """
-with count_table as (
-{}
-)
-select
-  count(distinct video_id) as video_count
+SELECT_SEEN_VIDEO_IDS = """
+select distinct
+  id as video_id
 from
-  count_table
+  youtube_video_snippet
+where
+  id is not null
+"""
+
+UNLOAD_VIDEO_IDS = """
+unload (
+{query}
+)
+to 's3://{s3_bucket}/{prefix}'
+with (format = 'PARQUET', compression = 'SNAPPY')
 """
 
 CREATE_VIDEO_SNIPPET_JSON = """
@@ -146,132 +148,167 @@ LOCATION 's3://{s3_bucket}/youtube_complementary_video_snippet/'
 TBLPROPERTIES ('has_encrypted_data'='false')
 """
 
-SELECT_COMPLEMENTARY_VIDEO_SNIPPET = """
-WITH all_youtube_videos as
-(SELECT DISTINCT
-  substr(url_extract_parameter(tweet_url, 'v'), 1, 11) as video_id
+# a derived table because UNLOAD cannot wrap a WITH clause
+ALL_YOUTUBE_VIDEOS = """
+(SELECT
+  CASE
+    WHEN url_extract_host(tweet_url) = 'www.youtube.com' THEN substr(url_extract_parameter(tweet_url, 'v'), 1, 11)
+    WHEN tweet_url like '%youtu.be/%' THEN substr(replace(url_extract_path(tweet_url), '/'), 1, 11)
+  END as video_id
 FROM
   twint_screen_name twitter, UNNEST(twitter.urls) t (tweet_url)
-where
-  url_extract_host(tweet_url) = 'www.youtube.com'
-UNION
-SELECT DISTINCT
-  substr(replace(url_extract_path(tweet_url), '/'), 1, 11) as video_id
-FROM
-  twint_screen_name twitter, UNNEST(twitter.urls) t (tweet_url)
-where
-  tweet_url like '%youtu.be/%'
-UNION
-SELECT DISTINCT
-  substr(url_extract_parameter(tweet_url.expanded_url, 'v'), 1, 11) as video_id
+UNION ALL
+SELECT
+  CASE
+    WHEN url_extract_host(tweet_url.expanded_url) = 'www.youtube.com'
+      THEN substr(url_extract_parameter(tweet_url.expanded_url, 'v'), 1, 11)
+    WHEN tweet_url.expanded_url like '%youtu.be/%'
+      THEN substr(replace(url_extract_path(tweet_url.expanded_url), '/'), 1, 11)
+  END as video_id
 FROM
   tweepy_screen_name twitter, UNNEST(twitter.entities.urls) t (tweet_url)
-where
-  url_extract_host(tweet_url.expanded_url) = 'www.youtube.com'
-UNION
-SELECT DISTINCT
-  substr(replace(url_extract_path(tweet_url.expanded_url), '/'), 1, 11) as video_id
-FROM
-  tweepy_screen_name twitter, UNNEST(twitter.entities.urls) t (tweet_url)
-where
-  tweet_url.expanded_url like '%youtu.be/%'
-UNION
-SELECT DISTINCT
-  substr(url_extract_parameter(tweet_url, 'v'), 1, 11) as video_id
+UNION ALL
+SELECT
+  CASE
+    WHEN url_extract_host(tweet_url) = 'www.youtube.com' THEN substr(url_extract_parameter(tweet_url, 'v'), 1, 11)
+    WHEN tweet_url like '%youtu.be/%' THEN substr(replace(url_extract_path(tweet_url), '/'), 1, 11)
+  END as video_id
 FROM
   twint_video_id twitter, UNNEST(twitter.urls) t (tweet_url)
-where
-  url_extract_host(tweet_url) = 'www.youtube.com'
-UNION
-SELECT DISTINCT
-  substr(replace(url_extract_path(tweet_url), '/'), 1, 11) as video_id
-FROM
-  twint_video_id twitter, UNNEST(twitter.urls) t (tweet_url)
-where
-  tweet_url like '%youtu.be/%'
-UNION
-SELECT DISTINCT
-  substr(url_extract_parameter(tweet_url.expanded_url, 'v'), 1, 11) as video_id
+UNION ALL
+SELECT
+  CASE
+    WHEN url_extract_host(tweet_url.expanded_url) = 'www.youtube.com'
+      THEN substr(url_extract_parameter(tweet_url.expanded_url, 'v'), 1, 11)
+    WHEN tweet_url.expanded_url like '%youtu.be/%'
+      THEN substr(replace(url_extract_path(tweet_url.expanded_url), '/'), 1, 11)
+  END as video_id
 FROM
-  tweepy_video_id twitter, UNNEST(twitter.entities.urls) t (tweet_url)
-where
-  url_extract_host(tweet_url.expanded_url) = 'www.youtube.com'
-UNION
-SELECT DISTINCT
-  substr(replace(url_extract_path(tweet_url.expanded_url), '/'), 1, 11) as video_id
-FROM
-  tweepy_video_id twitter, UNNEST(twitter.entities.urls) t (tweet_url)
-where
-  tweet_url.expanded_url like '%youtu.be/%')
-select distinct video_id
-from all_youtube_videos
-where video_id not in (select id from youtube_video_snippet) and 
-video_id not in (select id from youtube_complementary_video_snippet);
+  tweepy_video_id twitter, UNNEST(twitter.entities.urls) t (tweet_url)) v
 """
 
-SELECT_COUNT_COMPLEMENTARY_VIDEO_SNIPPET = """
-WITH all_youtube_videos as
-(SELECT DISTINCT
-  substr(url_extract_parameter(tweet_url, 'v'), 1, 11) as video_id
-FROM
-  twint_screen_name twitter, UNNEST(twitter.urls) t (tweet_url)
-where
-  url_extract_host(tweet_url) = 'www.youtube.com'
-UNION
-SELECT DISTINCT
-  substr(replace(url_extract_path(tweet_url), '/'), 1, 11) as video_id
-FROM
-  twint_screen_name twitter, UNNEST(twitter.urls) t (tweet_url)
-where
-  tweet_url like '%youtu.be/%'
-UNION
-SELECT DISTINCT
-  substr(url_extract_parameter(tweet_url.expanded_url, 'v'), 1, 11) as video_id
-FROM
-  tweepy_screen_name twitter, UNNEST(twitter.entities.urls) t (tweet_url)
-where
-  url_extract_host(tweet_url.expanded_url) = 'www.youtube.com'
-UNION
-SELECT DISTINCT
-  substr(replace(url_extract_path(tweet_url.expanded_url), '/'), 1, 11) as video_id
-FROM
-  tweepy_screen_name twitter, UNNEST(twitter.entities.urls) t (tweet_url)
-where
-  tweet_url.expanded_url like '%youtu.be/%'
-UNION
-SELECT DISTINCT
-  substr(url_extract_parameter(tweet_url, 'v'), 1, 11) as video_id
-FROM
-  twint_video_id twitter, UNNEST(twitter.urls) t (tweet_url)
-where
-  url_extract_host(tweet_url) = 'www.youtube.com'
-UNION
-SELECT DISTINCT
-  substr(replace(url_extract_path(tweet_url), '/'), 1, 11) as video_id
-FROM
-  twint_video_id twitter, UNNEST(twitter.urls) t (tweet_url)
-where
-  tweet_url like '%youtu.be/%'
-UNION
-SELECT DISTINCT
-  substr(url_extract_parameter(tweet_url.expanded_url, 'v'), 1, 11) as video_id
-FROM
-  tweepy_video_id twitter, UNNEST(twitter.entities.urls) t (tweet_url)
-where
-  url_extract_host(tweet_url.expanded_url) = 'www.youtube.com'
-UNION
-SELECT DISTINCT
-  substr(replace(url_extract_path(tweet_url.expanded_url), '/'), 1, 11) as video_id
-FROM
-  tweepy_video_id twitter, UNNEST(twitter.entities.urls) t (tweet_url)
-where
-  tweet_url.expanded_url like '%youtu.be/%')
-select count(distinct video_id) as video_count
-from all_youtube_videos
-where video_id not in (select id from youtube_video_snippet) and 
-video_id not in (select id from youtube_complementary_video_snippet);
+NOT_COLLECTED_YOUTUBE_VIDEOS = """left join youtube_video_snippet s on s.id = v.video_id
+left join youtube_complementary_video_snippet c on c.id = v.video_id
+where v.video_id is not null and s.id is null and c.id is null
 """
 
+SELECT_COMPLEMENTARY_VIDEO_SNIPPET = """
+select distinct v.video_id
+from""" + ALL_YOUTUBE_VIDEOS + NOT_COLLECTED_YOUTUBE_VIDEOS
+
+TMP_DIR = Path(__file__).parent / 'tmp'
+
+# Parquet files with the IDs of every video already stored in youtube_video_snippet
+SEEN_VIDEO_IDS_PREFIX = "youtube_video_snippet_seen_ids/"
+# outside SEEN_VIDEO_IDS_PREFIX so that it is never read as Parquet
+SEEN_VIDEO_IDS_SEEDED = "youtube_video_snippet_seen_ids.seeded"
+
+YOUTUBE_DISCOVERY_URL = "https://www.googleapis.com/discovery/v1/apis/youtube/v3/rest"
+
+# only the attributes stored by CREATE_VIDEO_SNIPPET_JSON
+VIDEO_SNIPPET_FIELDS = "kind,items(kind,etag,id,snippet(publishedAt,title,description,channelId,channelTitle," \
+                       "categoryId,tags,liveBroadcastContent,defaultLanguage,defaultAudioLanguage,localized,thumbnails))"
+
+
+def get_youtube_discovery_document():
+    # parsed once and shared by all clients
+    document = googleapiclient.discovery_cache.get_static_doc(serviceName="youtube", version="v3")
+    if document is None:
+        return read_dict_from_url(url=YOUTUBE_DISCOVERY_URL)
+    return orjson.loads(document)
+
+
+def build_youtube_client(discovery_document, http):
+    return googleapiclient.discovery.build_from_document(service=discovery_document, http=http)
+
+
+def parse_json_response(response, content):
+    # error responses never get here: execute() raises HttpError first
+    return orjson.loads(content)
+
+
+def chunks(iterable, size):
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
+
+
+def bounded_map(executor, function, arguments, max_pending):
+    # like executor.map, but with at most max_pending calls in flight
+    pending = set()
+    for argument in arguments:
+        if len(pending) >= max_pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+        pending.add(executor.submit(function, argument))
+    for future in as_completed(pending):
+        yield future.result()
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.timestamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+                self.timestamp = now
+                if self.tokens >= 1:
+                    self.tokens = self.tokens - 1
+                    return
+                wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+
+class SnippetCache:
+    # JSON lines already collected, kept for the TTL so that a rerun does not request them again
+    def __init__(self, filename, ttl):
+        self.filename = filename
+        self.ttl = ttl
+        self.thread_local = threading.local()
+        self.lock = threading.Lock()
+        self.connections = list()
+        self.oldest_retrieved_at = (datetime.utcnow() - self.ttl).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+        with self.connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS snippet (id TEXT PRIMARY KEY, json BLOB, retrieved_at TEXT)")
+            connection.execute("DELETE FROM snippet WHERE retrieved_at < ?", (self.oldest_retrieved_at,))
+
+    def connect(self):
+        # sqlite3 connections cannot be shared between threads
+        if getattr(self.thread_local, 'connection', None) is None:
+            self.thread_local.connection = sqlite3.connect(str(self.filename), check_same_thread=False)
+            with self.lock:
+                self.connections.append(self.thread_local.connection)
+        return self.thread_local.connection
+
+    def close(self):
+        with self.lock:
+            for connection in self.connections:
+                connection.close()
+            self.connections = list()
+            # threads that use the cache again get a new connection
+            self.thread_local = threading.local()
+
+    def get_many(self, video_ids):
+        rows = self.connect().execute(
+            "SELECT id, json FROM snippet WHERE retrieved_at >= ? AND id IN ({})".format(",".join("?" * len(video_ids))),
+            [self.oldest_retrieved_at] + list(video_ids))
+        return dict(rows)
+
+    def put_many(self, rows):
+        with self.connect() as connection:
+            connection.executemany("INSERT OR REPLACE INTO snippet (id, json, retrieved_at) VALUES (?, ?, ?)", rows)
+
 
 class YoutubeVideoSnippet:
     def __init__(self, credentials, athena_data, s3_admin, s3_data):
@@ -280,102 +317,278 @@ class YoutubeVideoSnippet:
         self.athena_data = athena_data
         self.s3_admin = s3_admin
         self.s3_data = s3_data
+        self.valid_keys = list(range(len(self.credentials)))
+        self.key_turns = count()
+        self.key_lock = threading.Lock()
+        self.thread_local = threading.local()
+        self.rate_limiter = TokenBucket(rate=self.REQUESTS_PER_SECOND, capacity=self.REQUESTS_PER_SECOND)
+        self.discovery_document = get_youtube_discovery_document()
+        TMP_DIR.mkdir(parents=True, exist_ok=True)
+        self.snippet_cache = SnippetCache(filename=TMP_DIR / 'snippet_cache.db', ttl=self.SNIPPET_CACHE_TTL)
+        self.aws_session = boto3.session.Session()
+        # the pool must hold at least max_concurrency connections, or the upload threads queue up for one
+        self.s3 = self.aws_session.client('s3', config=Config(max_pool_connections=32, retries={'mode': 'adaptive'}))
+        self.transfer_config = TransferConfig(multipart_threshold=8 * 1024 * 1024,
+                                              multipart_chunksize=16 * 1024 * 1024,
+                                              max_concurrency=16,
+                                              use_threads=True)
 
     LOGGING_INTERVAL = 100
-    WAIT_WHEN_SERVICE_UNAVAILABLE = 30
-    WAIT_WHEN_CONNECTION_RESET_BY_PEER = 60
+    MAX_WAIT = 60
+    NUM_WORKERS = 16
+    # videos.list accepts up to 50 comma-separated IDs per request
+    VIDEOS_PER_REQUEST = 50
+    REQUESTS_PER_SECOND = 20
+    VIDEO_ID_BATCH_SIZE = 10000
+    MAX_SEEN_VIDEO_ID_FILES = 50
+    CHECKPOINT_INTERVAL = 100000
+    SNIPPET_CACHE_TTL = timedelta(days=1)
+
+    @contextmanager
+    def start_workers(self):
+        with closing(self.snippet_cache), ThreadPoolExecutor(max_workers=self.NUM_WORKERS) as executor:
+            try:
+                yield executor
+            except BaseException:
+                # do not spend quota on queued batches nobody will read
+                executor.shutdown(cancel_futures=True)
+                raise
+
+    def get_youtube_client(self, rebuild=False):
+        # httplib2 is not thread-safe; build_http sets the socket timeout
+        if rebuild or getattr(self.thread_local, 'youtube', None) is None:
+            self.thread_local.youtube = build_youtube_client(discovery_document=self.discovery_document,
+                                                             http=googleapiclient.http.build_http())
+        return self.thread_local.youtube
+
+    def get_developer_key(self):
+        # round-robin, so that all quotas are used at the same time
+        with self.key_lock:
+            if not self.valid_keys:
+                raise RuntimeError("All developer keys are invalid")
+            return self.valid_keys[next(self.key_turns) % len(self.valid_keys)]
+
+    def discard_developer_key(self, key):
+        with self.key_lock:
+            # several workers may hit the same exhausted key
+            if key in self.valid_keys:
+                logging.info("Invalid {} developer key: {}".format(key, self.credentials[key]['developer_key']))
+                self.valid_keys.remove(key)
+            return len(self.valid_keys) > 0
+
+    def fetch_video_snippets(self, video_ids):
+        cached = self.snippet_cache.get_many(video_ids)
+        missing_video_ids = [video_id for video_id in video_ids if video_id not in cached]
+        lines = list(cached.values())
+        if missing_video_ids:
+            rows = self.build_video_snippets(video_ids=missing_video_ids,
+                                             response=self.request_video_snippets(missing_video_ids))
+            # cached here so that a failed run does not request them again
+            self.snippet_cache.put_many(rows)
+            lines.extend(line for _, line, _ in rows)
+        return video_ids, lines
+
+    def request_video_snippets(self, video_ids):
+        connection_reset_by_peer = 0
+        service_unavailable = 0
+        youtube = self.get_youtube_client()
+        key = self.get_developer_key()
+        while True:
+            self.rate_limiter.acquire()
+            try:
+                request = youtube.videos().list(part="snippet",
+                                                id=",".join(video_ids),
+                                                fields=VIDEO_SNIPPET_FIELDS,
+                                                key=self.credentials[key]['developer_key'])
+                request.postproc = parse_json_response
+                return request.execute()
+            except SocketError as e:
+                if e.errno != errno.ECONNRESET and not isinstance(e, SocketTimeout):
+                    logging.info("Other socket error!")
+                    raise
+                connection_reset_by_peer = connection_reset_by_peer + 1
+                logging.info("Connection reset by peer or timed out! {}".format(connection_reset_by_peer))
+                if connection_reset_by_peer > 10:
+                    raise
+                time.sleep(min(self.MAX_WAIT, 2 ** connection_reset_by_peer + random.random()))
+                youtube = self.get_youtube_client(rebuild=True)
+            except HttpError as e:
+                if e.resp.status == 403:
+                    if not self.discard_developer_key(key):
+                        raise
+                    key = self.get_developer_key()
+                elif e.resp.status == 503:
+                    service_unavailable = service_unavailable + 1
+                    logging.info("Service unavailable {}".format(service_unavailable))
+                    if service_unavailable > 10:
+                        raise
+                    time.sleep(min(self.MAX_WAIT, 2 ** service_unavailable + random.random()))
+                else:
+                    raise
+
+    def unload_video_ids(self, athena, query):
+        prefix = "unload/youtube_video_ids/{}/".format(uuid.uuid4().hex)
+        athena.query_athena_and_wait(query_string=UNLOAD_VIDEO_IDS.format(query=query,
+                                                                           s3_bucket=self.s3_admin,
+                                                                           prefix=prefix))
+        return prefix
+
+    def s3_prefix_is_empty(self, bucket, prefix):
+        return self.s3.list_objects_v2(Bucket=bucket, Prefix=prefix, MaxKeys=1)['KeyCount'] == 0
+
+    def list_s3_keys(self, bucket, prefix):
+        for page in self.s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+            for content in page.get('Contents', ()):
+                yield content['Key']
+
+    def delete_s3_keys(self, bucket, keys):
+        # delete_objects takes up to 1000 keys per request
+        for keys_chunk in chunks(keys, 1000):
+            self.s3.delete_objects(Bucket=bucket, Delete={'Objects': [{'Key': key} for key in keys_chunk]})
+
+    def delete_s3_prefix(self, bucket, prefix):
+        self.delete_s3_keys(bucket=bucket, keys=list(self.list_s3_keys(bucket=bucket, prefix=prefix)))
+
+    def connect_duckdb(self):
+        connection = duckdb.connect()
+        connection.execute("INSTALL httpfs")
+        connection.execute("LOAD httpfs")
+        # credential_chain resolves the credentials like boto3 does
+        connection.execute("INSTALL aws")
+        connection.execute("LOAD aws")
+        secret = "CREATE SECRET (TYPE S3, PROVIDER credential_chain"
+        if self.aws_session.region_name is not None:
+            secret = secret + ", REGION '{}'".format(self.aws_session.region_name)
+        connection.execute(secret + ")")
+        return connection
+
+    def seed_seen_video_ids(self, athena):
+        # one-off, for deployments that predate the seen IDs files
+        if not self.s3_prefix_is_empty(self.s3_data, SEEN_VIDEO_IDS_SEEDED):
+            return
+        if athena.table_exists("youtube_video_snippet"):
+            logging.info("Seed processed video IDs from table youtube_video_snippet")
+            # UNLOAD needs an empty destination
+            self.delete_s3_prefix(bucket=self.s3_data, prefix=SEEN_VIDEO_IDS_PREFIX)
+            # registers parts uploaded by a run that failed before recreating the table
+            athena.query_athena_and_wait(query_string="MSCK REPAIR TABLE youtube_video_snippet")
+            athena.query_athena_and_wait(query_string=UNLOAD_VIDEO_IDS.format(query=SELECT_SEEN_VIDEO_IDS,
+                                                                               s3_bucket=self.s3_data,
+                                                                               prefix=SEEN_VIDEO_IDS_PREFIX))
+        self.s3.put_object(Bucket=self.s3_data, Key=SEEN_VIDEO_IDS_SEEDED, Body=b'')
+
+    def load_pending_video_ids(self, connection, prefix, exclude_seen=True):
+        # the caller deletes the unloaded files
+        if self.s3_prefix_is_empty(self.s3_admin, prefix):
+            connection.execute("CREATE TABLE pending_video_ids (video_id VARCHAR)")
+        else:
+            query = "SELECT candidate.video_id FROM read_parquet('s3://{}/{}*') candidate".format(self.s3_admin, prefix)
+            if exclude_seen and not self.s3_prefix_is_empty(self.s3_data, SEEN_VIDEO_IDS_PREFIX):
+                query = query + " ANTI JOIN read_parquet('s3://{}/{}*') seen ON candidate.video_id = seen.video_id" \
+                    .format(self.s3_data, SEEN_VIDEO_IDS_PREFIX)
+            connection.execute("CREATE TABLE pending_video_ids AS {}".format(query))
+        return connection.execute("SELECT count(*) FROM pending_video_ids").fetchone()[0]
+
+    def stream_video_ids(self, connection):
+        reader = connection.execute("SELECT video_id FROM pending_video_ids").to_arrow_reader(self.VIDEO_ID_BATCH_SIZE)
+        for batch in reader:
+            yield from batch.column(0).to_pylist()
+
+    def save_seen_video_ids(self, video_ids):
+        if not video_ids:
+            return
+        seen_file = TMP_DIR / 'seen_video_ids.parquet'
+        pyarrow.parquet.write_table(pyarrow.table({'video_id': pyarrow.array(video_ids, type=pyarrow.string())}),
+                                   seen_file)
+        self.upload_seen_video_ids(seen_file)
+
+    def upload_seen_video_ids(self, seen_file):
+        s3_filename = "{}{}.parquet".format(SEEN_VIDEO_IDS_PREFIX, uuid.uuid4().hex)
+        logging.info("Upload file %s to bucket %s at %s", seen_file, self.s3_data, s3_filename)
+        self.s3.upload_file(str(seen_file), self.s3_data, s3_filename)
+
+    def compact_seen_video_ids(self, connection):
+        # every checkpoint adds a file and every run reads all of them
+        keys = list(self.list_s3_keys(bucket=self.s3_data, prefix=SEEN_VIDEO_IDS_PREFIX))
+        if len(keys) <= self.MAX_SEEN_VIDEO_ID_FILES:
+            return
+        logging.info("Compact %d files of processed video IDs", len(keys))
+        seen_file = TMP_DIR / 'seen_video_ids.parquet'
+        connection.execute("COPY (SELECT DISTINCT video_id FROM read_parquet([{}])) TO '{}' (FORMAT PARQUET)".format(
+            ", ".join("'s3://{}/{}'".format(self.s3_data, key) for key in keys),
+            seen_file))
+        self.upload_seen_video_ids(seen_file)
+        # a failure in between only leaves duplicate IDs behind
+        self.delete_s3_keys(bucket=self.s3_data, keys=keys)
+
+    def build_video_snippets(self, video_ids, response):
+        retrieved_at = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+        unavailable = set(video_ids)
+        rows = list()
+        for item in response.get('items') or ():
+            unavailable.discard(item['id'])
+            # publishedAt is always ISO 8601 in UTC, e.g. 2020-01-01T00:00:00Z
+            item['snippet']['publishedAt'] = item['snippet']['publishedAt'][:-1].replace('T', ' ', 1)
+            item['retrieved_at'] = retrieved_at
+            rows.append((item['id'], orjson.dumps(item), retrieved_at))
+        for video_id in video_ids:
+            if video_id in unavailable:
+                unavailable_video = {
+                    'kind': response.get('kind'),
+                    'id': video_id,
+                    'retrieved_at': retrieved_at,
+                    'description': "Video unavailable. It has probably been removed by the user."
+                }
+                rows.append((video_id, orjson.dumps(unavailable_video), retrieved_at))
+        return rows
+
+    def write_video_snippets(self, json_writer, lines):
+        if lines:
+            json_writer.write(b"\n".join(lines) + b"\n")
+
+    def upload_video_snippets(self, output_json, video_ids):
+        s3_filename = "youtube_video_snippet/creation_date={}/{}-{}.json.bz2".format(datetime.utcnow().strftime("%Y-%m-%d"),
+                                                                                     uuid.uuid4().hex,
+                                                                                     len(video_ids))
+        logging.info("Upload file %s to bucket %s at %s", output_json, self.s3_data, s3_filename)
+        self.s3.upload_file(str(output_json), self.s3_data, s3_filename, Config=self.transfer_config)
+        self.save_seen_video_ids(video_ids)
 
     def collect_complementary_video_snippets(self):
         logging.info("Start collecting complementary video snippets")
         athena = AthenaDatabase(database=self.athena_data, s3_output=self.s3_admin)
         logging.info("Download IDs for all Youtube videos that have not been processed yet")
-        video_count = int(athena.query_athena_and_get_result(query_string=SELECT_COUNT_COMPLEMENTARY_VIDEO_SNIPPET)['video_count'])
-        logging.info("There are %d links to be processed: download them", video_count)
-        video_ids_csv = athena.query_athena_and_download(query_string=SELECT_COMPLEMENTARY_VIDEO_SNIPPET, filename="video_ids.csv")
-
-        output_json = Path(Path(__file__).parent, 'tmp', 'youtube_complementary_video_snippet.json')
-        Path(output_json).parent.mkdir(parents=True, exist_ok=True)
-        current_key = 0
-        try:
-            youtube = googleapiclient.discovery.build(serviceName="youtube",
-                                                      version="v3",
-                                                      developerKey=
-                                                      self.credentials[current_key]['developer_key'],
-                                                      cache_discovery=False)
-        except UnknownApiNameOrVersion as e:
-            service = read_dict_from_url(url="https://www.googleapis.com/discovery/v1/apis/youtube/v3/rest")
-            youtube = googleapiclient.discovery.build_from_document(service=service,
-                                                                    developerKey=self.credentials[current_key][
-                                                                        'developer_key'])
-        with open(video_ids_csv, newline='') as csv_reader:
-            with open(output_json, 'w') as json_writer:
-                reader = csv.DictReader(csv_reader)
+        output_json = TMP_DIR / 'youtube_complementary_video_snippet.json.bz2'
+        self.valid_keys = list(range(len(self.credentials)))
+        with self.connect_duckdb() as connection:
+            video_ids_prefix = self.unload_video_ids(athena=athena, query=SELECT_COMPLEMENTARY_VIDEO_SNIPPET)
+            try:
+                # the query already leaves out the videos of both snippet tables
+                video_count = self.load_pending_video_ids(connection=connection,
+                                                          prefix=video_ids_prefix,
+                                                          exclude_seen=False)
+            finally:
+                self.delete_s3_prefix(bucket=self.s3_admin, prefix=video_ids_prefix)
+            logging.info("There are %d links to be processed", video_count)
+            with bz2.open(output_json, 'wb', compresslevel=9) as json_writer:
                 num_videos = 0
-                for video_id in reader:
-                    if num_videos % self.LOGGING_INTERVAL == 0:
-                        logging.info("%d out of %d videos processed", num_videos, video_count)
-                    num_videos = num_videos + 1
-
-                    service_unavailable = 0
-                    no_response = True
-                    while no_response:
-                        try:
-                            response = youtube.videos().list(part="snippet",id=video_id['video_id']).execute()
-                            no_response = False
-                        except HttpError as e:
-                            if "403" in str(e):
-                                logging.info("Invalid {} developer key: {}".format(
-                                    current_key,
-                                    self.credentials[current_key]['developer_key']))
-                                current_key = current_key + 1
-                                if current_key >= len(self.credentials):
-                                    raise
-                                else:
-                                    try:
-                                        youtube = googleapiclient.discovery.build(serviceName="youtube",
-                                                                                  version="v3",
-                                                                                  developerKey=
-                                                                                  self.credentials[current_key][
-                                                                                      'developer_key'],
-                                                                                  cache_discovery=False)
-                                    except UnknownApiNameOrVersion as e:
-                                        service = read_dict_from_url(
-                                            url="https://www.googleapis.com/discovery/v1/apis/youtube/v3/rest")
-                                        youtube = googleapiclient.discovery.build_from_document(service=service,
-                                                                                                developerKey=
-                                                                                                self.credentials[
-                                                                                                    current_key][
-                                                                                                    'developer_key'])
-                            elif "503" in str(e):
-                                logging.info("Service unavailable")
-                                service_unavailable = service_unavailable + 1
-                                if service_unavailable <= 10:
-                                    time.sleep(self.WAIT_WHEN_SERVICE_UNAVAILABLE)
-                                else:
-                                    raise
-                            else:
-                                raise
-                    if len(response.get('items', [])) == 0:
-                        response['id'] = video_id['video_id']
-                        response['retrieved_at'] = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
-                        response['description'] = "Video unavailable. It has probably been removed by the user."
-                        json_writer.write("{}\n".format(json.dumps(response)))
-                    else:
-                        for item in response['items']:
-                            item['snippet']['publishedAt'] = item['snippet']['publishedAt'].rstrip('Z').replace('T', ' ')
-                            item['retrieved_at'] = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
-                            json_writer.write("{}\n".format(json.dumps(item)))
-
-        logging.info("Compress file %s", output_json)
-        compressed_file = compress(filename=output_json, delete_original=True)
-
-        s3 = boto3.resource('s3')
+                with self.start_workers() as executor:
+                    for video_ids, lines in bounded_map(executor,
+                                                                   self.fetch_video_snippets,
+                                                                   chunks(self.stream_video_ids(connection),
+                                                                          self.VIDEOS_PER_REQUEST),
+                                                                   max_pending=self.NUM_WORKERS * 4):
+                        if num_videos // self.LOGGING_INTERVAL != (num_videos + len(video_ids)) // self.LOGGING_INTERVAL:
+                            logging.info("%d out of %d videos processed", num_videos, video_count)
+                        num_videos = num_videos + len(video_ids)
+                        self.write_video_snippets(json_writer=json_writer, lines=lines)
+
         s3_filename = "youtube_complementary_video_snippet/creation_date={}/{}-{}.json.bz2".format(
             datetime.utcnow().strftime("%Y-%m-%d"),
             uuid.uuid4().hex,
             num_videos)
-        logging.info("Upload file %s to bucket %s at %s", compressed_file, self.s3_data, s3_filename)
-        s3.Bucket(self.s3_data).upload_file(str(compressed_file), s3_filename)
+        logging.info("Upload file %s to bucket %s at %s", output_json, self.s3_data, s3_filename)
+        self.s3.upload_file(str(output_json), self.s3_data, s3_filename, Config=self.transfer_config)
 
         logging.info("Recreate table for Youtube channel stats")
         athena.query_athena_and_wait(query_string="DROP TABLE IF EXISTS youtube_complementary_video_snippet")
@@ -387,134 +600,44 @@ class YoutubeVideoSnippet:
     def collect_video_snippets(self):
         logging.info("Start collecting video snippets")
         athena = AthenaDatabase(database=self.athena_data, s3_output=self.s3_admin)
-        if not athena.table_exists("youtube_video_snippet"):
-            select_twitter_stream_video = SELECT_TWITTER_STREAM_VIDEO
-            select_youtube_related_video = SELECT_YOUTUBE_RELATED_VIDEO
-        else:
-            logging.info("Table youtube_video_snippet exists")
-            select_twitter_stream_video = SELECT_TWITTER_STREAM_VIDEO + EXTRA_TWITTER_STREAM_VIDEO
-            select_youtube_related_video = SELECT_YOUTUBE_RELATED_VIDEO + EXTRA_YOUTUBE_RELATED_VIDEO
-        queries = [select_twitter_stream_video]
+        queries = [SELECT_TWITTER_STREAM_VIDEO]
         if athena.table_exists("youtube_related_video"):
-            queries.append(select_youtube_related_video)
-        query = " union all ".join(queries)
-        query_count = SELECT_COUNT.format(query)
-        query_group_by = SELECT_GROUP_BY.format(query)
+            queries.append(SELECT_YOUTUBE_RELATED_VIDEO)
+        query_group_by = SELECT_GROUP_BY.format(" union all ".join(queries))
         logging.info("Download IDs for all Youtube videos that have not been processed yet")
-        video_count = int(athena.query_athena_and_get_result(query_string=query_count)['video_count'])
-        logging.info("There are %d links to be processed: download them", video_count)
-        video_ids_csv = athena.query_athena_and_download(query_string=query_group_by, filename="video_ids.csv")
-
-        output_json = Path(Path(__file__).parent, 'tmp', 'youtube_video_snippet.json')
-        Path(output_json).parent.mkdir(parents=True, exist_ok=True)
-        current_key = 0
-        try:
-            youtube = googleapiclient.discovery.build(serviceName="youtube",
-                                                      version="v3",
-                                                      developerKey=
-                                                      self.credentials[current_key]['developer_key'],
-                                                      cache_discovery=False)
-        except UnknownApiNameOrVersion as e:
-            service = read_dict_from_url(url="https://www.googleapis.com/discovery/v1/apis/youtube/v3/rest")
-            youtube = googleapiclient.discovery.build_from_document(service=service,
-                                                                    developerKey=self.credentials[current_key][
-                                                                        'developer_key'])
-        with open(video_ids_csv, newline='') as csv_reader:
-            with open(output_json, 'w') as json_writer:
-                reader = csv.DictReader(csv_reader)
-                num_videos = 0
-                for video_id in reader:
-                    if num_videos % self.LOGGING_INTERVAL == 0:
-                        logging.info("%d out of %d videos processed", num_videos, video_count)
-                    num_videos = num_videos + 1
-
-                    connection_reset_by_peer = 0
-                    service_unavailable = 0
-                    no_response = True
-                    response = dict()
-                    while no_response:
-                        try:
-                            response = youtube.videos().list(part="snippet",id=video_id['video_id']).execute()
-                            no_response = False
-                        except SocketError as e:
-                            if e.errno != errno.ECONNRESET:
-                                logging.info("Other socket error!")
-                                raise
-                            else:
-                                connection_reset_by_peer = connection_reset_by_peer + 1
-                                logging.info("Connection reset by peer! {}".format(connection_reset_by_peer))
-                                if connection_reset_by_peer <= 10:
-                                    time.sleep(self.WAIT_WHEN_CONNECTION_RESET_BY_PEER)
-                                    try:
-                                        youtube = googleapiclient.discovery.build(serviceName="youtube",
-                                                                                  version="v3",
-                                                                                  developerKey=
-                                                                                  self.credentials[current_key][
-                                                                                      'developer_key'],
-                                                                                  cache_discovery=False)
-                                    except UnknownApiNameOrVersion as e:
-                                        service = read_dict_from_url(
-                                            url="https://www.googleapis.com/discovery/v1/apis/youtube/v3/rest")
-                                        youtube = googleapiclient.discovery.build_from_document(service=service,
-                                                                                                developerKey=
-                                                                                                self.credentials[
-                                                                                                    current_key][
-                                                                                                    'developer_key'])
-                                else:
-                                    raise
-                        except HttpError as e:
-                            if "403" in str(e):
-                                logging.info("Invalid {} developer key: {}".format(
-                                    current_key,
-                                    self.credentials[current_key]['developer_key']))
-                                current_key = current_key + 1
-                                if current_key >= len(self.credentials):
-                                    raise
-                                else:
-                                    try:
-                                        youtube = googleapiclient.discovery.build(serviceName="youtube",
-                                                                                  version="v3",
-                                                                                  developerKey=
-                                                                                  self.credentials[current_key][
-                                                                                      'developer_key'],
-                                                                                  cache_discovery=False)
-                                    except UnknownApiNameOrVersion as e:
-                                        service = read_dict_from_url(
-                                            url="https://www.googleapis.com/discovery/v1/apis/youtube/v3/rest")
-                                        youtube = googleapiclient.discovery.build_from_document(service=service,
-                                                                                                developerKey=
-                                                                                                self.credentials[
-                                                                                                    current_key][
-                                                                                                    'developer_key'])
-                            elif "503" in str(e):
-                                logging.info("Service unavailable")
-                                service_unavailable = service_unavailable + 1
-                                if service_unavailable <= 10:
-                                    time.sleep(self.WAIT_WHEN_SERVICE_UNAVAILABLE)
-                                else:
-                                    raise
-                            else:
-                                raise
-                    if len(response.get('items', [])) == 0:
-                        response['id'] = video_id['video_id']
-                        response['retrieved_at'] = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
-                        response['description'] = "Video unavailable. It has probably been removed by the user."
-                        json_writer.write("{}\n".format(json.dumps(response)))
-                    else:
-                        for item in response['items']:
-                            item['snippet']['publishedAt'] = item['snippet']['publishedAt'].rstrip('Z').replace('T', ' ')
-                            item['retrieved_at'] = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
-                            json_writer.write("{}\n".format(json.dumps(item)))
-
-        logging.info("Compress file %s", output_json)
-        compressed_file = compress(filename=output_json, delete_original=True)
-
-        s3 = boto3.resource('s3')
-        s3_filename = "youtube_video_snippet/creation_date={}/{}-{}.json.bz2".format(datetime.utcnow().strftime("%Y-%m-%d"),
-                                                                                     uuid.uuid4().hex,
-                                                                                     num_videos)
-        logging.info("Upload file %s to bucket %s at %s", compressed_file, self.s3_data, s3_filename)
-        s3.Bucket(self.s3_data).upload_file(str(compressed_file), s3_filename)
+        self.seed_seen_video_ids(athena=athena)
+
+        output_json = TMP_DIR / 'youtube_video_snippet.json.bz2'
+        self.valid_keys = list(range(len(self.credentials)))
+        with self.connect_duckdb() as connection:
+            self.compact_seen_video_ids(connection=connection)
+            video_ids_prefix = self.unload_video_ids(athena=athena, query=query_group_by)
+            try:
+                video_count = self.load_pending_video_ids(connection=connection, prefix=video_ids_prefix)
+            finally:
+                self.delete_s3_prefix(bucket=self.s3_admin, prefix=video_ids_prefix)
+            logging.info("There are %d links to be processed", video_count)
+            num_videos = 0
+            with self.start_workers() as executor:
+                responses = bounded_map(executor,
+                                        self.fetch_video_snippets,
+                                        chunks(self.stream_video_ids(connection), self.VIDEOS_PER_REQUEST),
+                                        max_pending=self.NUM_WORKERS * 4)
+                # every CHECKPOINT_INTERVAL videos are uploaded as a part and marked as processed
+                while True:
+                    part_video_ids = list()
+                    with bz2.open(output_json, 'wb', compresslevel=9) as json_writer:
+                        for video_ids, lines in responses:
+                            if num_videos // self.LOGGING_INTERVAL != (num_videos + len(video_ids)) // self.LOGGING_INTERVAL:
+                                logging.info("%d out of %d videos processed", num_videos, video_count)
+                            num_videos = num_videos + len(video_ids)
+                            part_video_ids.extend(video_ids)
+                            self.write_video_snippets(json_writer=json_writer, lines=lines)
+                            if len(part_video_ids) >= self.CHECKPOINT_INTERVAL:
+                                break
+                    if not part_video_ids:
+                        break
+                    self.upload_video_snippets(output_json=output_json, video_ids=part_video_ids)
 
         logging.info("Recreate table for Youtube channel stats")
         athena.query_athena_and_wait(query_string="DROP TABLE IF EXISTS youtube_video_snippet")